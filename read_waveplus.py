@@ -26,31 +26,64 @@
 # Module import dependencies
 # ===============================
 
-from bluepy.btle import UUID, Peripheral, Scanner, DefaultDelegate
+from bluepy.btle import UUID, Peripheral, Scanner, DefaultDelegate, BTLEException
 import argparse
+import json
+import math
+import os
 import sys
 import time
 import struct
-import tableprint
+
+# Layout of the current-values characteristic, compiled once at import
+_WAVE_STRUCT = struct.Struct('<BBBBHHHHHHHH')
+
+# Manufacturer data prefix: Airthings company ID followed by the serial number
+_MANU_STRUCT = struct.Struct('<HI')
+_MANU_PREFIX_HEX = "3403" # 0x0334, little-endian
+
+# Device discovery: number of scan passes and length of each one, in seconds
+SCAN_PASSES = 2
+SCAN_WINDOW = 2.0
+
+# Serial number -> MAC address of previously discovered devices
+MAC_CACHE_PATH = os.path.expanduser("~/.waveplus_cache.json")
 
 # ====================================
 # Utility functions for WavePlus class
 # ====================================
 
 def parseSerialNumber(ManuDataHexStr):
-    if (ManuDataHexStr == None or ManuDataHexStr == "None"):
-        SN = "Unknown"
-    else:
-        ManuData = bytearray.fromhex(ManuDataHexStr)
+    if (ManuDataHexStr is None or ManuDataHexStr == "None"):
+        return "Unknown"
+    ManuData = bytes.fromhex(ManuDataHexStr)
+    if (len(ManuData) < _MANU_STRUCT.size):
+        return "Unknown"
+    CompanyId, SN = _MANU_STRUCT.unpack_from(ManuData, 0)
+    return SN if CompanyId == 0x0334 else "Unknown"
+
+def loadMacCache():
+    try:
+        with open(MAC_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {} # Missing, unreadable or corrupt cache: scan as usual
+    return cache if isinstance(cache, dict) else {}
 
-        if (((ManuData[1] << 8) | ManuData[0]) == 0x0334):
-            SN  =  ManuData[2]
-            SN |= (ManuData[3] << 8)
-            SN |= (ManuData[4] << 16)
-            SN |= (ManuData[5] << 24)
-        else:
-            SN = "Unknown"
-    return SN
+def saveMacCache(cache):
+    try:
+        with open(MAC_CACHE_PATH, "w") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass # Caching is best effort only
+
+def updateMacCache(SerialNumber, MacAddr):
+    cache = loadMacCache()
+    if (MacAddr is None):
+        cache.pop(str(SerialNumber), None)
+    else:
+        cache[str(SerialNumber)] = MacAddr
+    saveMacCache(cache)
 
 # ===============================
 # Class WavePlus
@@ -60,10 +93,12 @@ class WavePlus():
     def __init__(self, SerialNumber, hasAirQuality=False):
         self.periph        = None
         self.curr_val_char = None
-        self.MacAddr       = None
         self.SN            = SerialNumber
+        self.MacAddr       = loadMacCache().get(str(SerialNumber))
+        self.MacFromCache  = self.MacAddr is not None
         self.uuid          = "b42e2a68-ade7-11e4-89d3-123b93f75cba" if hasAirQuality else "b42e4dcc-ade7-11e4-89d3-123b93f75cba"
         self.numSensors    = 7 if hasAirQuality else 4
+        self._sensors      = Sensors(self.numSensors) # Reused by every read()
 
     def getNumSensors(self):
         return self.numSensors
@@ -73,11 +108,16 @@ class WavePlus():
         if (self.MacAddr is None):
             scanner     = Scanner().withDelegate(DefaultDelegate())
             searchCount = 0
-            while self.MacAddr is None and searchCount < 50:
-                devices      = scanner.scan(0.1) # 0.1 seconds scan period
+            while self.MacAddr is None and searchCount < SCAN_PASSES:
+                # A window longer than the advertising interval catches the
+                # device in one pass instead of stitching many short scans
+                devices      = scanner.scan(SCAN_WINDOW)
                 searchCount += 1
                 for dev in devices:
                     ManuData = dev.getValueText(255)
+                    # Cheap check on the company ID before decoding the hex string
+                    if (ManuData is None or not ManuData.startswith(_MANU_PREFIX_HEX)):
+                        continue
                     SN = parseSerialNumber(ManuData)
                     if (SN == self.SN):
                         self.MacAddr = dev.addr # exits the while loop on next conditional check
@@ -90,6 +130,8 @@ class WavePlus():
                 print("       (3) Retry connection.")
                 sys.exit(1)
 
+            updateMacCache(self.SN, self.MacAddr)
+
         # Connect to device
         try:
             if (self.periph is None):
@@ -98,21 +140,32 @@ class WavePlus():
             if (self.curr_val_char is None):
                 self.curr_val_char = self.periph.getCharacteristics(uuid=self.uuid)[0]
         except Exception as e:
-           raise Exception("Failed to connect. Check if device is on and if you are close enough.")
-
+            if (self.MacFromCache):
+                # The cached address may be stale: forget it and rediscover
+                self.periph        = None
+                self.curr_val_char = None
+                self.MacAddr       = None
+                self.MacFromCache  = False
+                updateMacCache(self.SN, None)
+                return self.connect()
+            raise Exception("Failed to connect. Check if device is on and if you are close enough.")
+
+    # Returns the same Sensors object on every call, updated in place;
+    # consume its values before the next read().
     def read(self):
         if (self.curr_val_char is None):
             print("ERROR: Devices are not connected.")
             sys.exit(1)
-        rawdata = self.curr_val_char.read()
-        rawdata = struct.unpack('<BBBBHHHHHHHH', rawdata)
-        sensors = Sensors(self.numSensors)
-        sensors.set(rawdata)
-        return sensors
+        rawdata = _WAVE_STRUCT.unpack_from(self.curr_val_char.read(), 0)
+        self._sensors.set(rawdata)
+        return self._sensors
 
     def disconnect(self):
         if self.periph is not None:
-            self.periph.disconnect()
+            try:
+                self.periph.disconnect()
+            except BTLEException:
+                pass # Link already lost; just drop the handles below
             self.periph = None
             self.curr_val_char = None
 
@@ -128,27 +181,27 @@ class Sensors():
     REL_ATM_PRESSURE     = 4
     CO2_LVL              = 5
     VOC_LVL              = 6
+    UNITS                = ["%rH", "Bq/m3", "Bq/m3", "degC", "hPa", "ppm", "ppb"]
     def __init__(self, numberOfSensors):
         self.sensor_version = None
         self.numberOfSensors = numberOfSensors
         self.sensor_data    = [None]*numberOfSensors
-        self.sensor_units   = ["%rH", "Bq/m3", "Bq/m3", "degC", "hPa", "ppm", "ppb"][:numberOfSensors]
+        self.sensor_units   = Sensors.UNITS[:numberOfSensors]
 
     def set(self, rawData):
-        self.sensor_version = rawData[0]
+        (version, humidity, _, _, radonShortTerm, radonLongTerm,
+         temperature, pressure, co2, voc, _, _) = rawData
+        self.sensor_version = version
         if (self.sensor_version == 1):
-            processor = {
-                Sensors.HUMIDITY                 : rawData[1]/2.0,
-                Sensors.RADON_SHORT_TERM_AVG     : self.conv2radon(rawData[4]),
-                Sensors.RADON_LONG_TERM_AVG      : self.conv2radon(rawData[5]),
-                Sensors.TEMPERATURE              : rawData[6]/100.0,
-                Sensors.REL_ATM_PRESSURE         : rawData[7]/50.0,
-                Sensors.CO2_LVL                  : rawData[8]*1.0,
-                Sensors.VOC_LVL                  : rawData[9]*1.0
-            }
-
-            for sensor in range(self.numberOfSensors):
-                self.sensor_data[sensor] = processor[sensor]
+            self.sensor_data[Sensors.HUMIDITY]             = humidity/2.0
+            self.sensor_data[Sensors.RADON_SHORT_TERM_AVG] = self.conv2radon(radonShortTerm)
+            self.sensor_data[Sensors.RADON_LONG_TERM_AVG]  = self.conv2radon(radonLongTerm)
+            self.sensor_data[Sensors.TEMPERATURE]          = temperature/100.0
+            # Pressure, CO2 and VOC only exist on devices with air quality sensors
+            if (self.numberOfSensors > Sensors.REL_ATM_PRESSURE):
+                self.sensor_data[Sensors.REL_ATM_PRESSURE] = pressure/50.0
+                self.sensor_data[Sensors.CO2_LVL]          = co2*1.0
+                self.sensor_data[Sensors.VOC_LVL]          = voc*1.0
 
         else:
             print("ERROR: Unknown sensor version.\n")
@@ -156,10 +209,9 @@ class Sensors():
             sys.exit(1)
 
     def conv2radon(self, radon_raw):
-        radon = "N/A" # Either invalid measurement, or not available
         if 0 <= radon_raw <= 16383:
-            radon  = radon_raw
-        return radon
+            return radon_raw
+        return float('nan') # Either invalid measurement, or not available
 
     def getValue(self, sensor_index):
         return self.sensor_data[sensor_index]
@@ -185,11 +237,19 @@ if __name__ == "__main__":
 
     parser.add_argument('--plain',
                         help='Does not format the output for pretty printing.',
-                        )
+                        action='store_true' )
 
 
     args = parser.parse_args()
 
+    # tableprint is only needed for pretty printing, so import it on demand
+    if ( not args.plain ):
+        try:
+            import tableprint
+        except ImportError:
+            print("WARNING: tableprint is not installed, using plain output.")
+            args.plain = True
+
     try:
         #---- Initialize ----#
         waveplus = WavePlus(args.serial, args.hasAirQuality)
@@ -206,32 +266,38 @@ if __name__ == "__main__":
         else:
             print(header)
 
-        while True:
-            waveplus.connect()
+        # Units never change, so build the " <unit>" suffixes once
+        numSensors = waveplus.getNumSensors()
+        suffixes   = [ " " + unit for unit in Sensors.UNITS[:numSensors] ]
 
+        # Keep the link up between samples; reconnect only when it drops
+        waveplus.connect()
+
+        # Sample on a fixed monotonic grid so read/reconnect time does not
+        # accumulate into the period
+        next_tick = time.monotonic()
+
+        while True:
             # read values
-            sensors = waveplus.read()
-
-            numSensors = waveplus.getNumSensors()
-
-            formater = {
-                Sensors.HUMIDITY                : lambda: str(sensors.getValue(Sensors.HUMIDITY))             + " " + str(sensors.getUnit(Sensors.HUMIDITY)),
-                Sensors.RADON_SHORT_TERM_AVG    : lambda: str(sensors.getValue(Sensors.RADON_SHORT_TERM_AVG)) + " " + str(sensors.getUnit(Sensors.RADON_SHORT_TERM_AVG)),
-                Sensors.RADON_LONG_TERM_AVG     : lambda: str(sensors.getValue(Sensors.RADON_LONG_TERM_AVG))  + " " + str(sensors.getUnit(Sensors.RADON_LONG_TERM_AVG)),
-                Sensors.TEMPERATURE             : lambda: str(sensors.getValue(Sensors.TEMPERATURE))          + " " + str(sensors.getUnit(Sensors.TEMPERATURE)),
-                Sensors.REL_ATM_PRESSURE        : lambda: str(sensors.getValue(Sensors.REL_ATM_PRESSURE))     + " " + str(sensors.getUnit(Sensors.REL_ATM_PRESSURE)),
-                Sensors.CO2_LVL                 : lambda: str(sensors.getValue(Sensors.CO2_LVL))              + " " + str(sensors.getUnit(Sensors.CO2_LVL)),
-                Sensors.VOC_LVL                 : lambda: str(sensors.getValue(Sensors.VOC_LVL))              + " " + str(sensors.getUnit(Sensors.VOC_LVL))
-            }
-            data = [ formater[x]() for x in range(numSensors) ]
+            try:
+                sensors = waveplus.read()
+            except BTLEException:
+                waveplus.disconnect()
+                waveplus.connect()
+                sensors = waveplus.read()
+
+            data = [ f"{'N/A' if math.isnan(value) else value}{suffix}" for value, suffix in zip(sensors.sensor_data, suffixes) ]
             if ( not args.plain ):
                 print(tableprint.row(data, width=12))
             else:
                 print(data)
 
-            waveplus.disconnect()
-
-            time.sleep(args.period)
+            next_tick += args.period
+            now = time.monotonic()
+            if (next_tick < now and args.period > 0):
+                # Running late: skip the missed slots instead of bursting
+                next_tick += ((now - next_tick) // args.period + 1) * args.period
+            time.sleep(max(0, next_tick - now))
 
     except Exception as e:
         print(str(e))